@@ -1,11 +1,28 @@
 import os
+import re
+import sys
 import logging
 import asyncio
+import functools
 import hashlib
+import hmac
+import json
+import heapq
 import random
-import string
-from uuid import uuid4
-from datetime import datetime, timedelta, timezone
+import secrets
+import time
+import weakref
+from contextlib import asynccontextmanager, nullcontext
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+
+# 可选：uvloop 比默认事件循环快，Windows 上没有，装不上就用标准 asyncio
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Telegram 库
 from telegram import (
@@ -25,20 +42,29 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ConversationHandler,
-    PicklePersistence,
-    ApplicationHandlerStop
+    BasePersistence,
+    PersistenceInput,
+    ApplicationHandlerStop,
+    TypeHandler,
+    SimpleUpdateProcessor,
+    AIORateLimiter,
 )
 from telegram.constants import ParseMode
-from telegram.error import Forbidden, BadRequest
+from telegram.request import HTTPXRequest
+from telegram.error import Forbidden, BadRequest, TelegramError
 
 # 数据库库
-from sqlalchemy import Column, BigInteger, Text, DateTime, String, Integer, Boolean, select, ForeignKey, func, delete
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, BigInteger, Text, DateTime, String, Integer, Boolean, JSON, select, ForeignKey, func, delete, insert, Index
+from sqlalchemy import inspect as sa_inspect, update as sa_update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import declarative_base, relationship, selectinload, aliased
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 # 加密库
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 
 # --- 1. 配置与初始化 ---
 
@@ -54,6 +80,21 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "LifeSignal_Bot")
 GITHUB_REPO_URL = "https://github.com/ShiXinqiang/LifeSignal-Trust-Edition-"
+# 建表在发布阶段 (python main.py migrate) 执行，Docker 镜像启动前也会先跑一次；
+# 没有发布阶段的部署 / 本地开发可设置 LIFESIGNAL_AUTOCREATE=1 在启动时自动建表
+AUTO_CREATE_TABLES = os.getenv("LIFESIGNAL_AUTOCREATE", "").strip().lower() in {"1", "true", "yes", "on"}
+# 连接池大小，注意不要超过数据库套餐的最大连接数
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+# 连接回收周期（秒）：回收会连同 asyncpg 的预编译语句缓存一起丢掉，所以设得长一些，断线交给 pool_pre_ping 检测
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# 不同聊天之间并发处理的 update 数量上限（同一聊天内始终按顺序处理）
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+# 设置了公网地址就用 Webhook 接收 update（前面需要有 HTTPS 反向代理），否则退回长轮询
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+# Telegram 回调时会带上这个值，用来拒绝伪造的请求；不设置则每次启动随机生成
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
 
 if not TOKEN or not DATABASE_URL:
     logger.critical("❌ 启动失败: 缺少 TELEGRAM_BOT_TOKEN 或 DATABASE_URL")
@@ -63,7 +104,8 @@ if not ENCRYPTION_KEY:
     logger.warning("⚠️以此模式运行不安全！未检测到 ENCRYPTION_KEY，正在使用临时密钥。")
     ENCRYPTION_KEY = Fernet.generate_key().decode()
 
-cipher_suite = Fernet(ENCRYPTION_KEY.encode())
+# ENCRYPTION_KEY 可以用逗号分隔多把密钥：第一把用于加密，其余只用于解密轮换前的旧数据
+cipher_suite = MultiFernet([Fernet(k.strip().encode()) for k in ENCRYPTION_KEY.split(",") if k.strip()])
 
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql+asyncpg://", 1)
@@ -87,26 +129,211 @@ class User(Base):
     will_content = Column(Text, nullable=True)
     will_type = Column(String, default='text')
     will_recipients = Column(String, default="")
+    # 只允许显式 selectinload 加载，避免在异步代码里意外触发懒加载
+    contacts = relationship('EmergencyContact', lazy='raise')
+    wills = relationship('Will', lazy='raise', order_by='Will.created_at')
 
 class Will(Base):
     __tablename__ = 'wills'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(BigInteger, ForeignKey('users.chat_id'), index=True)
+    user_id = Column(BigInteger, ForeignKey('users.chat_id'))
     content = Column(Text)
     msg_type = Column(String)
+    # 文字信件前 12 个字单独加密存一份，列表页只解密这一小段
+    preview = Column(Text, nullable=True)
+    # 旧版逗号分隔的接收人，migrate 时会搬到 will_recipients 表，新数据不再写这一列
     recipient_ids = Column(String, default="")
     created_at = Column(DateTime(timezone=True), default=func.now())
+    recipients = relationship('WillRecipient', lazy='raise', passive_deletes=True)
+    # 信件列表按用户过滤、按创建时间排序，一个索引同时满足
+    __table_args__ = (Index('ix_wills_user_created', 'user_id', 'created_at'),)
+
+class WillRecipient(Base):
+    __tablename__ = 'will_recipients'
+    will_id = Column(Integer, ForeignKey('wills.id', ondelete='CASCADE'), primary_key=True)
+    contact_chat_id = Column(BigInteger, primary_key=True)
 
 class EmergencyContact(Base):
     __tablename__ = 'contacts'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    owner_chat_id = Column(BigInteger, ForeignKey('users.chat_id'), index=True)
-    contact_chat_id = Column(BigInteger)
+    owner_chat_id = Column(BigInteger, ForeignKey('users.chat_id'))
+    contact_chat_id = Column(BigInteger, index=True)
     contact_name = Column(String)
-
-engine = create_async_engine(DATABASE_URL, echo=False)
+    # 绑定时按 (主人, 守护人) 点查；唯一约束同时保证同一个人不会被重复绑定，也覆盖只按主人查的场景
+    __table_args__ = (Index('ix_contacts_owner_contact', 'owner_chat_id', 'contact_chat_id', unique=True),)
+
+class BotState(Base):
+    """PTB 的 user_data / chat_data / 会话状态，每个键一行"""
+    __tablename__ = 'bot_state'
+    kind = Column(String, primary_key=True)  # user / chat / bot / conv:<会话名>
+    key = Column(String, primary_key=True)
+    value = Column(JSON)
+
+# 失联扫描只看 active 用户，部分索引体积小且正好覆盖这个条件
+Index('ix_users_active_last_active', User.last_active, postgresql_where=(User.status == 'active'))
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    # 编译后的 SQL 缓存（SQLAlchemy 侧），语句形状固定，给足容量避免被挤出
+    query_cache_size=1200,
+    connect_args={
+        # JIT 开启时 asyncpg 的类型探测查询会很慢，小查询也用不上 JIT
+        "server_settings": {"jit": "off"},
+        "statement_cache_size": 1024,
+        "prepared_statement_cache_size": 512,
+    },
+)
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+# PTB 持久化（会话状态、user_data）专用的小连接池：这些数据丢了最多让用户重走一步，
+# 所以关闭 synchronous_commit，提交时不等 WAL 刷盘；用户、信件等业务数据仍走上面的 engine
+state_engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=2,
+    max_overflow=2,
+    pool_pre_ping=True,
+    pool_recycle=300,
+    connect_args={"server_settings": {"jit": "off", "synchronous_commit": "off"}},
+    # JSON 列（bot_state.value）用 orjson 编解码，每次持久化都要序列化整份 user_data
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads,
+)
+
+# 当前 update 共用的会话，由 BotUpdateProcessor 在处理每条 update 时设置
+_update_session = ContextVar("update_session", default=None)
+
+@asynccontextmanager
+async def db_session():
+    """handler 里用它取会话：同一条 update 内拦截器和各 handler 复用一个会话，其余场景单独开一个"""
+    session = _update_session.get()
+    if session is not None:
+        yield session
+    else:
+        async with AsyncSessionLocal() as session:
+            yield session
+
+class BotUpdateProcessor(SimpleUpdateProcessor):
+    """
+    1. 不同聊天的 update 并发处理，一个慢请求不会卡住其他人；
+       同一聊天的 update 排队按顺序处理，ConversationHandler 的状态不会乱
+    2. 每条 update 只借出一次连接：会话在处理完后统一关闭（未提交的读事务随之回滚）
+    """
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # 没有 update 在排队的聊天，锁会被自动回收
+        self._chat_locks = weakref.WeakValueDictionary()
+
+    def _chat_lock(self, update):
+        owner = update.effective_chat or update.effective_user
+        if owner is None:
+            return nullcontext()
+        lock = self._chat_locks.get(owner.id)
+        if lock is None:
+            lock = self._chat_locks[owner.id] = asyncio.Lock()
+        return lock
+
+    async def process_update(self, update, coroutine):
+        # 先排聊天锁再占并发名额：同一聊天排队中的 update 不占信号量，刷屏的用户挤不掉别人
+        async with self._chat_lock(update):
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        async with AsyncSessionLocal() as session:
+            token = _update_session.set(session)
+            try:
+                await coroutine
+            finally:
+                _update_session.reset(token)
+
+class SQLPersistence(BasePersistence):
+    """
+    把 PTB 的持久化数据存进 bot_state 表，取代整个文件重写的 PicklePersistence。
+    PTB 每隔 update_interval 秒只把变化过的键交过来，这里逐行 UPSERT / DELETE
+    """
+    def __init__(self, update_interval: float = 2.0):
+        # 只存 user_data 和会话状态：bot_data / chat_data 没用到，存了 PTB 也会每轮写一次空字典。
+        # 空闲时没有变化就不写库，所以间隔可以短，崩溃时最多丢 2 秒内的会话状态
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+
+    async def _load(self, kind):
+        async with state_engine.connect() as conn:
+            rows = (await conn.execute(select(BotState.key, BotState.value).where(BotState.kind == kind))).all()
+        return dict(rows)
+
+    async def _upsert(self, kind, key, value):
+        stmt = pg_insert(BotState).values(kind=kind, key=str(key), value=value)
+        stmt = stmt.on_conflict_do_update(index_elements=[BotState.kind, BotState.key], set_={"value": stmt.excluded.value})
+        async with state_engine.begin() as conn:
+            await conn.execute(stmt)
+
+    async def _delete(self, kind, key):
+        async with state_engine.begin() as conn:
+            await conn.execute(delete(BotState).where(BotState.kind == kind, BotState.key == str(key)))
+
+    async def get_user_data(self):
+        return {int(k): v for k, v in (await self._load("user")).items()}
+
+    async def get_chat_data(self):
+        return {int(k): v for k, v in (await self._load("chat")).items()}
+
+    async def get_bot_data(self):
+        return (await self._load("bot")).get("", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        # 会话的键是 (chat_id, user_id) 这样的元组，存成 JSON 数组字符串
+        return {tuple(json.loads(k)): v for k, v in (await self._load(f"conv:{name}")).items()}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self._delete(f"conv:{name}", json.dumps(key))
+        else:
+            await self._upsert(f"conv:{name}", json.dumps(key), new_state)
+
+    async def update_user_data(self, user_id, data):
+        await self._upsert("user", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._upsert("chat", chat_id, data)
+
+    async def update_bot_data(self, data):
+        await self._upsert("bot", "", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        await self._delete("user", user_id)
+
+    async def drop_chat_data(self, chat_id):
+        await self._delete("chat", chat_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # 每次 update_* 都已直接落库，没有需要在停机时补写的缓冲
+        pass
+
 # --- 3. 文案与 UI 定义 ---
 
 # 保持你要求的键盘文案不变
@@ -116,17 +343,34 @@ BTN_CONTACTS = "🛡️ 守护人管理"
 BTN_SETTINGS = "⏱️ 频率设置"
 BTN_SECURITY = "🔒 安全审计"
 
+# 需要先验证主密码的按钮 -> 验证通过后要打开的菜单
+PROTECTED_BUTTONS = {BTN_WILLS: 'wills', BTN_CONTACTS: 'contacts', BTN_SETTINGS: 'settings'}
+# 所有主键盘按钮，写信时误点了按钮就退出流程
+KEYBOARD_BUTTONS = frozenset([BTN_SAFE, BTN_SECURITY, *PROTECTED_BUTTONS])
+
+# 主键盘内容固定不变，导入时构建一次，所有回复共用（Telegram 对象本身不可变）
+_MAIN_MENU = ReplyKeyboardMarkup(
+    [
+        [BTN_SAFE],
+        [BTN_WILLS, BTN_CONTACTS],
+        [BTN_SETTINGS, BTN_SECURITY]
+    ],
+    resize_keyboard=True,
+    is_persistent=True,
+    input_field_placeholder="死了么LifeSignal 正在守护中..."
+)
+
 def get_main_menu() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [
-            [BTN_SAFE],
-            [BTN_WILLS, BTN_CONTACTS],
-            [BTN_SETTINGS, BTN_SECURITY]
-        ],
-        resize_keyboard=True,
-        is_persistent=True,
-        input_field_placeholder="死了么LifeSignal 正在守护中..."
-    )
+    return _MAIN_MENU
+
+# 内容固定的内联键盘同样只建一次
+FREQ_MENU = InlineKeyboardMarkup([[
+    InlineKeyboardButton("24小时", callback_data="set_freq_24"),
+    InlineKeyboardButton("3天", callback_data="set_freq_72"),
+    InlineKeyboardButton("7天", callback_data="set_freq_168"),
+]])
+BACK_TO_WILLS = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回列表", callback_data="menu_wills")]])
+BACK_TO_CONTACTS = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回列表", callback_data="menu_contacts")]])
 
 (
     STATE_SET_PASSWORD,
@@ -139,14 +383,45 @@ def get_main_menu() -> ReplyKeyboardMarkup:
 
 CTX_NEXT_ACTION = 'next_action'
 CTX_UNLOCK_TARGET = 'unlock_target_id'
+CTX_PICKER_CONTACTS = 'picker_contacts'
+CTX_VERIFIED_UNTIL = 'verified_until'
+
+# 验证通过后的免输入窗口：连续进出几个隐私菜单不必每次都重新跑一遍 Argon2
+PASSWORD_GRACE_SECONDS = 120
 
 # --- 4. 辅助函数 ---
 
+# Argon2id 参数只初始化一次，所有请求复用同一个 hasher
+PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=1)
+
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    return PASSWORD_HASHER.hash(password)
+
+def verify_password(stored_hash: str, password: str) -> bool:
+    """校验主密码，兼容旧版本存下的无盐 SHA-256 十六进制哈希"""
+    if not stored_hash: return False
+    if not stored_hash.startswith("$argon2"):
+        return hmac.compare_digest(stored_hash, hashlib.sha256(password.encode()).hexdigest())
+    try:
+        return PASSWORD_HASHER.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(stored_hash: str) -> bool:
+    return not stored_hash.startswith("$argon2") or PASSWORD_HASHER.check_needs_rehash(stored_hash)
 
 def generate_unlock_key() -> str:
-    return ''.join(random.choices(string.digits, k=6))
+    # 恢复密钥等同于解锁凭证，必须用密码学安全的随机数
+    return f"{secrets.randbelow(1_000_000):06d}"
+
+# 密码哈希、批量解密这类 CPU 密集操作放到独立线程池，避免卡住事件循环里的其他聊天
+CRYPTO_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="crypto")
+
+async def run_crypto(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(CRYPTO_POOL, fn, *args)
+
+# 列表页展示的文字预览长度
+WILL_PREVIEW_LEN = 12
 
 def encrypt_data(data: str) -> str:
     if not data: return None
@@ -159,17 +434,94 @@ def decrypt_data(encrypted_data: str) -> str:
     except Exception:
         return "[数据无法读取]"
 
-async def auto_delete_message(context, chat_id, message_id, delay=1):
-    try:
-        await asyncio.sleep(delay)
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-    except Exception:
-        pass
+# 列表页预览缓存：键是密文本身，信件内容或密钥一变密文就变，旧条目自然不再命中；
+# 只缓存前 WILL_PREVIEW_LEN 个字，不会把整封信的明文留在内存里
+@functools.lru_cache(maxsize=4096)
+def decrypt_preview(token):
+    plain = decrypt_data(token)
+    return plain[:WILL_PREVIEW_LEN] if plain else plain
+
+def decrypt_previews(tokens):
+    return [decrypt_preview(t) for t in tokens]
+
+# 自动删除队列：所有"N 秒后删掉这条消息"的请求进同一个最小堆 (到期时间, chat_id, message_id)，
+# 由一个后台任务统一处理，到期的消息按聊天分组后用 deleteMessages 一次删一批
+DELETE_FLUSH_INTERVAL = 0.2
+DELETE_BATCH_LIMIT = 100  # deleteMessages 单次最多 100 条
+_delete_heap = []
+_delete_wakeup = asyncio.Event()
+
+def schedule_delete(chat_id, message_id, delay=1):
+    heapq.heappush(_delete_heap, (time.monotonic() + delay, chat_id, message_id))
+    _delete_wakeup.set()
+
+async def _flush_deletes(bot, chat_id, message_ids):
+    for i in range(0, len(message_ids), DELETE_BATCH_LIMIT):
+        try:
+            await bot.delete_messages(chat_id, message_ids[i:i + DELETE_BATCH_LIMIT])
+        except TelegramError as e:
+            # 消息已被用户删掉 / 超过 48 小时无法删除都属正常，不值得告警
+            logger.debug(f"🧹 清理消息失败 {chat_id}: {e}")
+
+async def delete_worker(bot):
+    while True:
+        _delete_wakeup.clear()
+        if not _delete_heap:
+            await _delete_wakeup.wait()
+            continue
+        wait = _delete_heap[0][0] - time.monotonic()
+        if wait > 0:
+            # 有更早到期的消息加入时会被提前唤醒
+            try: await asyncio.wait_for(_delete_wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError: pass
+            continue
+        # 稍等一个窗口，把同一时刻前后到期的删除合并成一次请求
+        await asyncio.sleep(DELETE_FLUSH_INTERVAL)
+        now = time.monotonic()
+        batches = {}
+        while _delete_heap and _delete_heap[0][0] <= now:
+            _, chat_id, message_id = heapq.heappop(_delete_heap)
+            batches.setdefault(chat_id, []).append(message_id)
+        await asyncio.gather(*(_flush_deletes(bot, cid, ids) for cid, ids in batches.items()))
+
+# 报平安合并写入：同一时刻多人报平安时一条 UPDATE 处理一批、只提交一次；
+# 每个人仍然等自己的那批落库后才收到"已确认平安"，不会回复了却没写进去
+HEARTBEAT_BATCH_LIMIT = 100
+_heartbeat_queue = asyncio.Queue()
+
+async def record_heartbeat(chat_id):
+    """重置倒计时；返回 False 表示该用户还没有守护人（或已冻结），倒计时没有重置"""
+    fut = asyncio.get_running_loop().create_future()
+    _heartbeat_queue.put_nowait((chat_id, fut))
+    return await fut
+
+async def heartbeat_worker():
+    while True:
+        batch = [await _heartbeat_queue.get()]
+        while len(batch) < HEARTBEAT_BATCH_LIMIT and not _heartbeat_queue.empty():
+            batch.append(_heartbeat_queue.get_nowait())
+        has_contacts = select(EmergencyContact.id).where(EmergencyContact.owner_chat_id == User.chat_id).exists()
+        stmt = (
+            sa_update(User)
+            .where(User.chat_id.in_({cid for cid, _ in batch}), User.is_locked.is_not(True), has_contacts)
+            .values(last_active=func.now(), status='active')
+            .returning(User.chat_id)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            async with AsyncSessionLocal() as session:
+                updated = set((await session.execute(stmt)).scalars().all())
+                await session.commit()
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done(): fut.set_exception(e)
+            continue
+        for cid, fut in batch:
+            if not fut.done(): fut.set_result(cid in updated)
 
 async def get_db_user(session, chat_id, username=None):
-    stmt = select(User).where(User.chat_id == chat_id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
+    # 按主键取：同一会话里已加载过的直接从 identity map 返回，不再发 SQL
+    user = await session.get(User, chat_id)
     if not user:
         user = User(chat_id=chat_id, username=username)
         session.add(user)
@@ -178,97 +530,174 @@ async def get_db_user(session, chat_id, username=None):
     return user
 
 async def get_contacts(session, owner_id):
-    stmt = select(EmergencyContact).where(EmergencyContact.owner_chat_id == owner_id)
-    result = await session.execute(stmt)
-    return result.scalars().all()
+    """守护人列表只取展示和勾选要用的三列，不构造 ORM 实体"""
+    stmt = (
+        select(EmergencyContact.id, EmergencyContact.contact_chat_id, EmergencyContact.contact_name)
+        .where(EmergencyContact.owner_chat_id == owner_id)
+    )
+    return (await session.execute(stmt)).all()
+
+async def get_picker_contacts(context, owner_id, refresh=False):
+    """勾选接收人时用的守护人列表 [[chat_id, 名字], ...]：打开菜单时查一次库存进 user_data，之后每次勾选直接复用"""
+    cached = None if refresh else context.user_data.get(CTX_PICKER_CONTACTS)
+    if cached is None:
+        async with db_session() as session:
+            contacts = await get_contacts(session, owner_id)
+        cached = context.user_data[CTX_PICKER_CONTACTS] = [[c.contact_chat_id, c.contact_name] for c in contacts]
+    return cached
+
+async def get_will_previews(session, user_id):
+    """信件列表只取 ID、类型和加密预览（没有预览的老数据退回正文），不把整段正文拉回来"""
+    stmt = (
+        select(Will.id, Will.msg_type, func.coalesce(Will.preview, Will.content).label('preview'))
+        .where(Will.user_id == user_id)
+        .order_by(Will.created_at)
+    )
+    return (await session.execute(stmt)).all()
+
+async def add_contacts(session, rows):
+    """批量写入守护人：rows 是字段字典列表，多行合并成一条 INSERT"""
+    if rows: await session.execute(insert(EmergencyContact), rows)
 
-async def get_wills(session, user_id):
-    stmt = select(Will).where(Will.user_id == user_id).order_by(Will.created_at)
-    result = await session.execute(stmt)
+async def add_wills(session, rows):
+    """批量写入信件：rows 是字段字典列表，多行合并成一条 INSERT，按顺序返回新信件 ID"""
+    if not rows: return []
+    result = await session.execute(insert(Will).returning(Will.id, sort_by_parameter_order=True), rows)
     return result.scalars().all()
 
+async def get_will_recipient_ids(session, will_id):
+    stmt = select(WillRecipient.contact_chat_id).where(WillRecipient.will_id == will_id)
+    return set((await session.execute(stmt)).scalars().all())
+
+async def set_will_recipients(session, will_id, contact_ids):
+    """整体替换一封信的接收人：先删后插，插入只用一条语句"""
+    await session.execute(delete(WillRecipient).where(WillRecipient.will_id == will_id))
+    if contact_ids:
+        await session.execute(insert(WillRecipient), [dict(will_id=will_id, contact_chat_id=cid) for cid in contact_ids])
+
+# 被冻结用户集合：启动时从库里加载，之后随冻结 / 解冻同步维护。
+# 绝大多数 update 来自未冻结用户，拦截器只做一次集合查找，不碰数据库
+_locked_users = set()
+
+async def load_locked_users():
+    async with AsyncSessionLocal() as session:
+        ids = (await session.execute(select(User.chat_id).where(User.is_locked.is_(True)))).scalars().all()
+    _locked_users.clear()
+    _locked_users.update(ids)
+
+def set_lock_state(chat_id, locked):
+    """冻结 / 解冻写库提交后调用"""
+    if locked:
+        _locked_users.add(chat_id)
+    else:
+        _locked_users.discard(chat_id)
+
+async def get_unlock_key(chat_id):
+    async with db_session() as session:
+        return (await session.execute(select(User.unlock_key).where(User.chat_id == chat_id))).scalar()
+
 # --- 5. 核心逻辑：安全熔断与鉴权 ---
 
 async def global_lock_interceptor(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 只拦普通消息和按钮回调，内联查询等其他 update 直接放行
+    if not (update.message or update.callback_query): return
     user = update.effective_user
     if not user: return
     
     # 自动删除用户发的消息（保持界面整洁）
     if update.message:
-        context.application.create_task(auto_delete_message(context, user.id, update.message.message_id, 1))
+        schedule_delete(user.id, update.message.message_id, 1)
+
+    if user.id not in _locked_users: return
 
     try:
-        async with AsyncSessionLocal() as session:
-            db_user = await get_db_user(session, user.id)
-            if db_user.is_locked:
-                key_display = db_user.unlock_key if db_user.unlock_key else "ERROR"
-                alert = (
-                    "⛔️ 账户已暂时冻结\n\n"
-                    "为了保护您的数据安全，系统检测到多次错误操作，已自动锁定。\n\n"
-                    "如何解锁？\n"
-                    "1. 请联系您的守护人（您绑定的紧急联系人）。\n"
-                    f"2. 把这个【恢复密钥】发给他： {key_display}\n"
-                    "3. 他输入/unlock再输入密钥，您的账户就会立刻恢复。"
-                )
-                if update.message:
-                    msg = await update.message.reply_text(alert)
-                    context.application.create_task(auto_delete_message(context, user.id, msg.message_id, 30))
-                elif update.callback_query:
-                    await update.callback_query.answer("⛔️ 拒绝访问：请联系守护人解锁", show_alert=True)
-                raise ApplicationHandlerStop
-    except ApplicationHandlerStop:
-        raise
+        unlock_key = await get_unlock_key(user.id)
     except Exception:
-        pass
+        logger.exception(f"❌ 读取恢复密钥失败: {user.id}")
+        unlock_key = None
+    key_display = unlock_key if unlock_key else "ERROR"
+    alert = (
+        "⛔️ 账户已暂时冻结\n\n"
+        "为了保护您的数据安全，系统检测到多次错误操作，已自动锁定。\n\n"
+        "如何解锁？\n"
+        "1. 请联系您的守护人（您绑定的紧急联系人）。\n"
+        f"2. 把这个【恢复密钥】发给他： {key_display}\n"
+        "3. 他输入/unlock再输入密钥，您的账户就会立刻恢复。"
+    )
+    try:
+        if update.message:
+            msg = await update.message.reply_text(alert)
+            schedule_delete(user.id, msg.message_id, 30)
+        elif update.callback_query:
+            await update.callback_query.answer("⛔️ 拒绝访问：请联系守护人解锁", show_alert=True)
+    except TelegramError as e:
+        logger.warning(f"⚠️ 冻结提示发送失败 {user.id}: {e}")
+    # 冻结用户的 update 到此为止：提示发没发出去，后续分组的处理器都不再执行
+    raise ApplicationHandlerStop
 
 async def request_password_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
     
-    if text == BTN_WILLS: context.user_data[CTX_NEXT_ACTION] = 'wills'
-    elif text == BTN_CONTACTS: context.user_data[CTX_NEXT_ACTION] = 'contacts'
-    elif text == BTN_SETTINGS: context.user_data[CTX_NEXT_ACTION] = 'settings'
+    context.user_data[CTX_NEXT_ACTION] = PROTECTED_BUTTONS[text]
+
+    # 这里只需要知道设没设过密码，不必加载整行用户
+    async with db_session() as session:
+        has_password = (await session.execute(
+            select(User.password_hash.is_not(None)).where(User.chat_id == user_id)
+        )).scalar()
+    if not has_password:
+        msg = await update.message.reply_text("👋 首次使用，请直接发送您想设置的主密码（以后进入隐私区域需要用到）：")
+        schedule_delete(user_id, msg.message_id, 20)
+        return ConversationHandler.END
 
-    async with AsyncSessionLocal() as session:
-        user = await get_db_user(session, user_id)
-        if not user.password_hash:
-            msg = await update.message.reply_text("👋 首次使用，请直接发送您想设置的主密码（以后进入隐私区域需要用到）：")
-            context.application.create_task(auto_delete_message(context, user_id, msg.message_id, 20))
-            return ConversationHandler.END
+    if context.user_data.get(CTX_VERIFIED_UNTIL, 0) > time.time():
+        schedule_delete(user_id, update.message.message_id, 0)
+        await open_protected_menu(update, context)
+        return ConversationHandler.END
 
     prompt = await update.message.reply_text("🔐 隐私保护\n这里包含敏感信息，请输入您的主密码：")
-    context.application.create_task(auto_delete_message(context, user_id, prompt.message_id, 30))
+    schedule_delete(user_id, prompt.message_id, 30)
     return STATE_VERIFY_PASSWORD
 
+async def open_protected_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    action = context.user_data.get(CTX_NEXT_ACTION)
+    if action == 'wills': await show_will_menu(update, context)
+    elif action == 'contacts': await show_contacts_menu(update, context)
+    elif action == 'settings': await show_freq_menu(update, context)
+
 async def handle_password_verification(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     user_id = update.effective_user.id
     input_pwd = msg.text
-    context.application.create_task(auto_delete_message(context, user_id, msg.message_id, 0))
+    schedule_delete(user_id, msg.message_id, 0)
 
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         user = await get_db_user(session, user_id)
-        if hash_password(input_pwd) == user.password_hash:
+        if await run_crypto(verify_password, user.password_hash, input_pwd):
             user.login_attempts = 0
+            # 旧哈希（或参数已调整）在验证成功时顺手升级
+            if password_needs_rehash(user.password_hash):
+                user.password_hash = await run_crypto(hash_password, input_pwd)
             await session.commit()
-            action = context.user_data.get(CTX_NEXT_ACTION)
-            if action == 'wills': await show_will_menu(update, context)
-            elif action == 'contacts': await show_contacts_menu(update, context)
-            elif action == 'settings': await show_freq_menu(update, context)
+            context.user_data[CTX_VERIFIED_UNTIL] = time.time() + PASSWORD_GRACE_SECONDS
+            await open_protected_menu(update, context)
             return ConversationHandler.END
         else:
             user.login_attempts += 1
+            context.user_data.pop(CTX_VERIFIED_UNTIL, None)
             if user.login_attempts >= 5:
                 user.is_locked = True
                 user.unlock_key = generate_unlock_key()
                 await session.commit()
+                set_lock_state(user_id, True)
                 warn = await msg.reply_text("⛔️ 密码错误次数过多，账户已冻结！")
-                context.application.create_task(auto_delete_message(context, user_id, warn.message_id, 15))
+                schedule_delete(user_id, warn.message_id, 15)
                 return ConversationHandler.END
             else:
                 await session.commit()
                 retry_msg = await msg.reply_text(f"❌ 密码错误，请重试 (还剩 {5 - user.login_attempts} 次机会)")
-                context.application.create_task(auto_delete_message(context, user_id, retry_msg.message_id, 5))
+                schedule_delete(user_id, retry_msg.message_id, 5)
                 return STATE_VERIFY_PASSWORD
 
 # --- 6. 守护人解锁流程 (已修复) ---
@@ -282,20 +711,21 @@ async def start_remote_unlock(update: Update, context: ContextTypes.DEFAULT_TYPE
     executor_id = update.effective_user.id
     
     # 立即删除 /unlock 指令
-    context.application.create_task(auto_delete_message(context, executor_id, update.message.message_id, 1))
+    schedule_delete(executor_id, update.message.message_id, 1)
+
+    async with db_session() as session:
+        # 一次查询直接拿到"我守护的、且已冻结"的用户，不再逐个 session.get
+        stmt = (
+            select(User)
+            .join(EmergencyContact, EmergencyContact.owner_chat_id == User.chat_id)
+            .where(EmergencyContact.contact_chat_id == executor_id, User.is_locked.is_(True))
+            .distinct()
+        )
+        locked_users = (await session.execute(stmt)).scalars().all()
 
-    async with AsyncSessionLocal() as session:
-        stmt = select(EmergencyContact).where(EmergencyContact.contact_chat_id == executor_id)
-        entrustments = (await session.execute(stmt)).scalars().all()
-        
-        locked_users = []
-        for ent in entrustments:
-            user = await session.get(User, ent.owner_chat_id)
-            if user and user.is_locked: locked_users.append(user)
-        
         if not locked_users:
             msg = await update.message.reply_text("✅ 您守护的人目前都很安全，没有账户被冻结。")
-            context.application.create_task(auto_delete_message(context, executor_id, msg.message_id, 10))
+            schedule_delete(executor_id, msg.message_id, 10)
             return ConversationHandler.END
         
         kb = [[InlineKeyboardButton(f"🔓 解锁: {u.username or u.chat_id}", callback_data=f"select_locked_{u.chat_id}")] for u in locked_users]
@@ -328,17 +758,19 @@ async def verify_unlock_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_id = context.user_data.get(CTX_UNLOCK_TARGET)
     
     # 删除密钥消息
-    context.application.create_task(auto_delete_message(context, update.effective_user.id, msg.message_id, 1))
+    schedule_delete(update.effective_user.id, msg.message_id, 1)
     
-    async with AsyncSessionLocal() as session:
-        target_user = await get_db_user(session, target_id)
+    async with db_session() as session:
+        # 只读目标用户，不存在时不要像 get_db_user 那样顺手建一行
+        target_user = await session.get(User, target_id) if target_id else None
         
-        if input_key == target_user.unlock_key:
+        if target_user and target_user.unlock_key and input_key == target_user.unlock_key:
             target_user.is_locked = False
             target_user.login_attempts = 0
             target_user.unlock_key = None
             target_user.password_hash = None # 强制重置密码
             await session.commit()
+            set_lock_state(target_id, False)
             
             await msg.reply_text("✅ 操作成功！对方的账户已解锁，并被强制要求重置密码。")
             try: 
@@ -347,20 +779,21 @@ async def verify_unlock_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "🎉 账户已恢复！\n您的守护人已帮您解锁。由于原密码可能泄露，请重新设置一个新密码。", 
                     reply_markup=get_main_menu()
                 )
-            except: pass
+            except TelegramError as e:
+                logger.warning(f"⚠️ 解锁通知发送失败 {target_id}: {e}")
             return ConversationHandler.END
         else:
             fail_msg = await msg.reply_text("❌ 密钥不对，请重新核对。")
-            context.application.create_task(auto_delete_message(context, update.effective_user.id, fail_msg.message_id, 10))
+            schedule_delete(update.effective_user.id, fail_msg.message_id, 10)
             return ConversationHandler.END # 也可以选择不END，允许重试，这里END简单点
 
 # --- 7. 基础功能 ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    context.application.create_task(auto_delete_message(context, user.id, update.message.message_id, 1))
+    schedule_delete(user.id, update.message.message_id, 1)
 
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         db_user = await get_db_user(session, user.id, user.username)
 
         # 处理别人发来的邀请链接
@@ -397,10 +830,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def set_password_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pwd = update.message.text
-    context.application.create_task(auto_delete_message(context, update.effective_user.id, update.message.message_id, 1))
-    async with AsyncSessionLocal() as session:
+    schedule_delete(update.effective_user.id, update.message.message_id, 1)
+    async with db_session() as session:
         u = await get_db_user(session, update.effective_user.id)
-        u.password_hash = hash_password(pwd)
+        u.password_hash = await run_crypto(hash_password, pwd)
         await session.commit()
     await update.message.reply_text("✅ 密码设置成功，请牢记它。", reply_markup=get_main_menu())
     return ConversationHandler.END
@@ -410,14 +843,17 @@ async def set_password_finish(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def show_will_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """显示预设信箱主列表"""
     user_id = update.effective_user.id
-    async with AsyncSessionLocal() as session:
-        wills = await get_wills(session, user_id)
+    async with db_session() as session:
+        wills = await get_will_previews(session, user_id)
+        texts = [w for w in wills if w.msg_type == 'text']
+        # 整批预览一次交给线程池；命中缓存的几乎不花时间，不值得每条单独切一次线程
+        decrypted = await run_crypto(decrypt_previews, [w.preview for w in texts])
+        plaintext = {w.id: p for w, p in zip(texts, decrypted)}
         kb = []
         for w in wills:
             try:
-                decrypted = decrypt_data(w.content)
-                preview = (decrypted[:12] + "..") if w.msg_type == 'text' else f"[{w.msg_type.upper()}]"
-            except: preview = "Lock"
+                preview = (plaintext[w.id] + "..") if w.msg_type == 'text' else f"[{w.msg_type.upper()}]"
+            except TypeError: preview = "Lock"  # 内容为空，decrypt_data 返回了 None
             kb.append([InlineKeyboardButton(f"📄 {preview}", callback_data=f"view_will_{w.id}")])
         
         kb.append([InlineKeyboardButton("➕ 写一封新信", callback_data="add_will_start")])
@@ -428,177 +864,217 @@ async def show_will_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
         else:
             msg = await context.bot.send_message(user_id, text, reply_markup=InlineKeyboardMarkup(kb))
-            context.application.create_task(auto_delete_message(context, user_id, msg.message_id, 60))
+            schedule_delete(user_id, msg.message_id, 60)
 
 async def show_contacts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         contacts = await get_contacts(session, user_id)
         kb = [[InlineKeyboardButton(f"❌ 删除 {c.contact_name}", callback_data=f"try_unbind_{c.id}")] for c in contacts]
         if len(contacts) < 10: kb.append([InlineKeyboardButton("➕ 邀请新守护人", switch_inline_query="invite")])
         msg = await context.bot.send_message(user_id, f"🛡️ 守护人列表 ({len(contacts)}人)\n\n这些人会在你失联时收到通知。", reply_markup=InlineKeyboardMarkup(kb))
-        context.application.create_task(auto_delete_message(context, user_id, msg.message_id, 60))
+        schedule_delete(user_id, msg.message_id, 60)
 
 async def show_freq_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    kb = [[InlineKeyboardButton("24小时", callback_data="set_freq_24"), InlineKeyboardButton("3天", callback_data="set_freq_72"), InlineKeyboardButton("7天", callback_data="set_freq_168")]]
-    msg = await context.bot.send_message(user_id, "⏱️ 调整失联判定时间\n\n如果你超过这个时间没来【确认平安】，系统就会判定你失联了，从而发出警报和遗嘱信。", reply_markup=InlineKeyboardMarkup(kb))
-    context.application.create_task(auto_delete_message(context, user_id, msg.message_id, 60))
+    msg = await context.bot.send_message(user_id, "⏱️ 调整失联判定时间\n\n如果你超过这个时间没来【确认平安】，系统就会判定你失联了，从而发出警报和遗嘱信。", reply_markup=FREQ_MENU)
+    schedule_delete(user_id, msg.message_id, 60)
 
 # --- 9. 核心交互回调处理 ---
 
-async def handle_global_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    user_id = update.effective_user.id
+# 全局回调路由：一次正则匹配同时取出动作和参数，再查表分发，不再逐个 startswith
+CALLBACK_PATTERN = re.compile(
+    r"^(menu_wills|menu_contacts|view_will|reveal|edit_rec|tgl_edit|save_edit|del_will|try_unbind|do_unbind|set_freq|cancel_cb)(?:_(.*))?$"
+)
 
-    # === 返回主列表 ===
-    if data == "menu_wills":
-        await show_will_menu(update, context)
+async def _cb_menu_wills(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    await show_will_menu(update, context)
 
-    # === 查看详情（控制台）===
-    elif data.startswith("view_will_"):
-        wid = int(data.split("_")[2])
-        async with AsyncSessionLocal() as session:
-            will = await session.get(Will, wid)
-            if not will:
-                await query.edit_message_text("❌ 这封信好像被删除了", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="menu_wills")]]))
-                return
-            
-            # 获取当前接收人姓名
-            rec_ids = will.recipient_ids.split(",") if will.recipient_ids else []
-            rec_names = []
-            if rec_ids:
-                contacts = await get_contacts(session, user_id)
-                name_map = {str(c.contact_chat_id): c.contact_name for c in contacts}
-                rec_names = [name_map.get(rid, "未知用户") for rid in rec_ids if rid]
-            
-            rec_str = ", ".join(rec_names) if rec_names else "还没指定人（不会发送）"
-            type_str = "文字" if will.msg_type == 'text' else "文件/图片"
-            
-            text = (
-                f"📄 信件详情 #{wid}\n\n"
-                f"• 类型：{type_str}\n"
-                f"• 创建时间：{will.created_at.strftime('%Y-%m-%d %H:%M')}\n"
-                f"• 发给谁：{rec_str}\n\n"
-                "你可以进行以下操作："
-            )
-            
-            kb = [
-                [InlineKeyboardButton("👁 查看内容", callback_data=f"reveal_{wid}"), InlineKeyboardButton("👥 修改接收人", callback_data=f"edit_rec_{wid}")],
-                [InlineKeyboardButton("🗑 删除这封信", callback_data=f"del_will_{wid}")],
-                [InlineKeyboardButton("🔙 返回列表", callback_data="menu_wills")]
-            ]
-            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-
-    # === 临时解密内容 ===
-    elif data.startswith("reveal_"):
-        wid = int(data.split("_")[1])
-        async with AsyncSessionLocal() as session:
-            will = await session.get(Will, wid)
-            if will:
-                content = decrypt_data(will.content)
-                if will.msg_type == 'text': m = await query.message.reply_text(f"🔐 解密后的内容 (15秒后销毁):\n\n{content}")
-                else: m = await query.message.reply_text(f"🔐 文件ID (15秒后销毁):\n{content}")
-                context.application.create_task(auto_delete_message(context, user_id, m.message_id, 15))
-
-    # === 修改接收人 (开始) ===
-    elif data.startswith("edit_rec_"):
-        wid = int(data.split("_")[2])
-        # 暂存正在编辑的 ID
-        context.user_data['editing_will_id'] = wid
-        async with AsyncSessionLocal() as session:
-            will = await session.get(Will, wid)
-            contacts = await get_contacts(session, user_id)
-            
-            if not contacts:
-                await query.answer("您还没有添加守护人，请先去添加。", show_alert=True)
-                return
-
-            current_ids = will.recipient_ids.split(",") if will.recipient_ids else []
-            # 存入临时状态
-            context.user_data[f'edit_sel_{wid}'] = [int(i) for i in current_ids if i]
-            
-            await render_edit_recipient_menu(query, contacts, wid, context)
+async def _cb_menu_contacts(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    await show_contacts_menu(update, context)
 
-    # === 修改接收人 (切换勾选) ===
-    elif data.startswith("tgl_edit_"):
-        parts = data.split("_")
-        wid = int(parts[2])
-        cid = int(parts[3])
-        
-        sel = context.user_data.get(f'edit_sel_{wid}', [])
-        if cid in sel: sel.remove(cid)
-        else: sel.append(cid)
-        context.user_data[f'edit_sel_{wid}'] = sel
+async def _cb_view_will(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """查看详情（控制台）"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    wid = int(arg)
+    async with db_session() as session:
+        will = await session.get(Will, wid)
+        if not will:
+            await query.edit_message_text("❌ 这封信好像被删除了", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回", callback_data="menu_wills")]]))
+            return
         
-        async with AsyncSessionLocal() as session:
+        # 获取当前接收人姓名
+        rec_ids = await get_will_recipient_ids(session, wid)
+        rec_names = []
+        if rec_ids:
             contacts = await get_contacts(session, user_id)
-            await render_edit_recipient_menu(query, contacts, wid, context)
-
-    # === 修改接收人 (保存) ===
-    elif data.startswith("save_edit_"):
-        wid = int(data.split("_")[2])
-        sel = context.user_data.get(f'edit_sel_{wid}', [])
-        rec_str = ",".join(map(str, sel))
+            name_map = {c.contact_chat_id: c.contact_name for c in contacts}
+            rec_names = [name_map.get(rid, "未知用户") for rid in rec_ids]
         
-        async with AsyncSessionLocal() as session:
-            will = await session.get(Will, wid)
-            will.recipient_ids = rec_str
-            await session.commit()
+        rec_str = ", ".join(rec_names) if rec_names else "还没指定人（不会发送）"
+        type_str = "文字" if will.msg_type == 'text' else "文件/图片"
         
-        # 清理临时数据
-        context.user_data.pop(f'edit_sel_{wid}', None)
-        context.user_data.pop('editing_will_id', None)
+        text = (
+            f"📄 信件详情 #{wid}\n\n"
+            f"• 类型：{type_str}\n"
+            f"• 创建时间：{will.created_at.strftime('%Y-%m-%d %H:%M')}\n"
+            f"• 发给谁：{rec_str}\n\n"
+            "你可以进行以下操作："
+        )
         
-        await query.answer("✅ 修改成功")
-        # 返回详情页
-        query.data = f"view_will_{wid}"
-        await handle_global_callbacks(update, context)
-
-    # === 删除信件 ===
-    elif data.startswith("del_will_"):
-        wid = int(data.split("_")[2])
-        async with AsyncSessionLocal() as session:
-            await session.execute(delete(Will).where(Will.id == wid))
-            await session.commit()
-        await query.edit_message_text("✅ 已删除", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回列表", callback_data="menu_wills")]]))
+        kb = [
+            [InlineKeyboardButton("👁 查看内容", callback_data=f"reveal_{wid}"), InlineKeyboardButton("👥 修改接收人", callback_data=f"edit_rec_{wid}")],
+            [InlineKeyboardButton("🗑 删除这封信", callback_data=f"del_will_{wid}")],
+            [InlineKeyboardButton("🔙 返回列表", callback_data="menu_wills")]
+        ]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
 
-    # === 解绑守护人 ===
-    elif data.startswith("try_unbind_"):
-        cid = int(data.split("_")[2])
-        kb = [[InlineKeyboardButton("⚠️ 确认删除", callback_data=f"do_unbind_{cid}"), InlineKeyboardButton("取消", callback_data="cancel_cb")]]
-        await query.edit_message_text("⚠️ 确定要删除这位守护人吗？删除后他将收不到通知。", reply_markup=InlineKeyboardMarkup(kb))
+async def _cb_reveal(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """临时解密内容"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    wid = int(arg)
+    async with db_session() as session:
+        will = await session.get(Will, wid)
+        if will:
+            content = decrypt_data(will.content)
+            if will.msg_type == 'text': m = await query.message.reply_text(f"🔐 解密后的内容 (15秒后销毁):\n\n{content}")
+            else: m = await query.message.reply_text(f"🔐 文件ID (15秒后销毁):\n{content}")
+            schedule_delete(user_id, m.message_id, 15)
+
+async def _cb_edit_rec(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """修改接收人 (开始)"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    wid = int(arg)
+    # 暂存正在编辑的 ID
+    context.user_data['editing_will_id'] = wid
+    contacts = await get_picker_contacts(context, user_id, refresh=True)
+    if not contacts:
+        await query.answer("您还没有添加守护人，请先去添加。", show_alert=True)
+        return
 
-    elif data.startswith("do_unbind_"):
-        cid = int(data.split("_")[2])
-        async with AsyncSessionLocal() as session:
-            c = await session.get(EmergencyContact, cid)
-            if c:
-                await session.delete(c)
-                await session.commit()
-        await query.edit_message_text("✅ 已删除", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回列表", callback_data="menu_contacts")]]))
+    # 存入临时状态
+    async with db_session() as session:
+        context.user_data[f'edit_sel_{wid}'] = list(await get_will_recipient_ids(session, wid))
 
-    elif data.startswith("set_freq_"):
-        h = int(data.split("_")[2])
-        async with AsyncSessionLocal() as session:
-            u = await get_db_user(session, user_id)
-            u.check_frequency = h
-            await session.commit()
-        await query.edit_message_text(f"✅ 设置成功！如果 {h} 小时没消息，我就启动预案。")
+    await render_edit_recipient_menu(query, contacts, wid, context)
+
+async def _cb_tgl_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """修改接收人 (切换勾选)，参数格式: WILLID_CONTACTID"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    wid_str, cid_str = arg.split("_")
+    wid, cid = int(wid_str), int(cid_str)
+    
+    sel = context.user_data.get(f'edit_sel_{wid}', [])
+    if cid in sel: sel.remove(cid)
+    else: sel.append(cid)
+    context.user_data[f'edit_sel_{wid}'] = sel
+    
+    contacts = await get_picker_contacts(context, user_id)
+    await render_edit_recipient_menu(query, contacts, wid, context)
+
+async def _cb_save_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """修改接收人 (保存)"""
+    query = update.callback_query
+    wid = int(arg)
+    sel = context.user_data.get(f'edit_sel_{wid}', [])
+    
+    async with db_session() as session:
+        await set_will_recipients(session, wid, sel)
+        await session.commit()
+    
+    # 清理临时数据
+    context.user_data.pop(f'edit_sel_{wid}', None)
+    context.user_data.pop('editing_will_id', None)
+    context.user_data.pop(CTX_PICKER_CONTACTS, None)
+    
+    await query.answer("✅ 修改成功")
+    # 返回详情页
+    await _cb_view_will(update, context, arg)
+
+async def _cb_del_will(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """删除信件"""
+    query = update.callback_query
+    wid = int(arg)
+    # 限定只能删自己的信；rowcount 为 0 说明已经删过（比如重复点击）
+    async with db_session() as session:
+        result = await session.execute(
+            delete(Will)
+            .where(Will.id == wid, Will.user_id == update.effective_user.id)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    text = "✅ 已删除" if result.rowcount else "这封信已经不存在了"
+    await query.edit_message_text(text, reply_markup=BACK_TO_WILLS)
+
+async def _cb_try_unbind(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """解绑守护人 (确认)"""
+    query = update.callback_query
+    cid = int(arg)
+    kb = [[InlineKeyboardButton("⚠️ 确认删除", callback_data=f"do_unbind_{cid}"), InlineKeyboardButton("取消", callback_data="cancel_cb")]]
+    await query.edit_message_text("⚠️ 确定要删除这位守护人吗？删除后他将收不到通知。", reply_markup=InlineKeyboardMarkup(kb))
 
-    elif data == "cancel_cb":
-        await query.edit_message_text("操作已取消")
+async def _cb_do_unbind(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    query = update.callback_query
+    cid = int(arg)
+    # 一条 DELETE 完成，同时限定只能删自己名下的守护人
+    async with db_session() as session:
+        result = await session.execute(
+            delete(EmergencyContact)
+            .where(EmergencyContact.id == cid, EmergencyContact.owner_chat_id == update.effective_user.id)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    text = "✅ 已删除" if result.rowcount else "这位守护人已经不在列表里了"
+    await query.edit_message_text(text, reply_markup=BACK_TO_CONTACTS)
+
+async def _cb_set_freq(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    query = update.callback_query
+    h = int(arg)
+    async with db_session() as session:
+        await session.execute(
+            sa_update(User).where(User.chat_id == update.effective_user.id).values(check_frequency=h)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    await query.edit_message_text(f"✅ 设置成功！如果 {h} 小时没消息，我就启动预案。")
+
+async def _cb_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    await update.callback_query.edit_message_text("操作已取消")
+
+CALLBACK_ROUTES = {
+    "menu_wills": _cb_menu_wills,
+    "menu_contacts": _cb_menu_contacts,
+    "view_will": _cb_view_will,
+    "reveal": _cb_reveal,
+    "edit_rec": _cb_edit_rec,
+    "tgl_edit": _cb_tgl_edit,
+    "save_edit": _cb_save_edit,
+    "del_will": _cb_del_will,
+    "try_unbind": _cb_try_unbind,
+    "do_unbind": _cb_do_unbind,
+    "set_freq": _cb_set_freq,
+    "cancel_cb": _cb_cancel,
+}
+
+async def handle_global_callbacks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """CallbackQueryHandler 已经用 CALLBACK_PATTERN 匹配过，这里直接复用匹配结果查表"""
+    await update.callback_query.answer()
+    action, arg = context.matches[0].group(1, 2)
+    await CALLBACK_ROUTES[action](update, context, arg)
 
 async def render_edit_recipient_menu(query, contacts, wid, context):
     """渲染修改接收人的复选框菜单"""
-    sel = context.user_data.get(f'edit_sel_{wid}', [])
+    # user_data 里存的是列表（要能序列化成 JSON），渲染时转成集合做成员判断
+    sel = frozenset(context.user_data.get(f'edit_sel_{wid}', []))
     kb = []
-    for c in contacts:
-        mark = "✅" if c.contact_chat_id in sel else "⭕️"
+    for cid, name in contacts:
+        mark = "✅" if cid in sel else "⭕️"
         # 回调数据: tgl_edit_WILLID_CONTACTID
-        kb.append([InlineKeyboardButton(f"{mark} {c.contact_name}", callback_data=f"tgl_edit_{wid}_{c.contact_chat_id}")])
+        kb.append([InlineKeyboardButton(f"{mark} {name}", callback_data=f"tgl_edit_{wid}_{cid}")])
     
     kb.append([InlineKeyboardButton("💾 保存修改", callback_data=f"save_edit_{wid}")])
     kb.append([InlineKeyboardButton("🔙 不改了，返回", callback_data=f"view_will_{wid}")])
@@ -614,7 +1090,7 @@ async def start_add_will(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def receive_will_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     # 如果用户误触了键盘按钮，直接退出流程
-    if msg.text and msg.text in [BTN_SAFE, BTN_WILLS, BTN_CONTACTS, BTN_SETTINGS]: return ConversationHandler.END
+    if msg.text and msg.text in KEYBOARD_BUTTONS: return ConversationHandler.END
     
     content, w_type = None, 'text'
     if msg.text: content, w_type = encrypt_data(msg.text), 'text'
@@ -624,24 +1100,25 @@ async def receive_will_content(update: Update, context: ContextTypes.DEFAULT_TYP
 
     context.user_data['temp_content'] = content
     context.user_data['temp_type'] = w_type
+    context.user_data['temp_preview'] = encrypt_data(msg.text[:WILL_PREVIEW_LEN]) if msg.text else None
     context.user_data['selected'] = []
     return await render_recipient_selector(update, context)
 
 async def render_recipient_selector(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    async with AsyncSessionLocal() as session:
-        contacts = await get_contacts(session, user_id)
-        if not contacts:
-             await context.bot.send_message(user_id, "⚠️ 您还没添加守护人，这封信没法发给别人。\n请先去【守护人管理】添加朋友。", reply_markup=get_main_menu())
-             return ConversationHandler.END
-        
-        sel = context.user_data.get('selected', [])
-        kb = [[InlineKeyboardButton(f"{'✅' if c.contact_chat_id in sel else '⭕️'} {c.contact_name}", callback_data=f"sel_rec_{c.contact_chat_id}")] for c in contacts]
-        kb.append([InlineKeyboardButton("💾 保存信件", callback_data="save_new_will")])
-        
-        text = "📨 这封信要在失联后发给谁？\n请勾选（可多选）："
-        if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-        else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+    # 刚写完信时查一次库，之后的勾选回调复用同一份列表
+    contacts = await get_picker_contacts(context, user_id, refresh=update.callback_query is None)
+    if not contacts:
+         await context.bot.send_message(user_id, "⚠️ 您还没添加守护人，这封信没法发给别人。\n请先去【守护人管理】添加朋友。", reply_markup=get_main_menu())
+         return ConversationHandler.END
+    
+    sel = frozenset(context.user_data.get('selected', []))
+    kb = [[InlineKeyboardButton(f"{'✅' if cid in sel else '⭕️'} {name}", callback_data=f"sel_rec_{cid}")] for cid, name in contacts]
+    kb.append([InlineKeyboardButton("💾 保存信件", callback_data="save_new_will")])
+    
+    text = "📨 这封信要在失联后发给谁？\n请勾选（可多选）："
+    if update.callback_query: await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+    else: await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
     return STATE_ADD_WILL_RECIPIENTS
 
 async def handle_recipient_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -658,39 +1135,33 @@ async def handle_recipient_toggle(update: Update, context: ContextTypes.DEFAULT_
         return await render_recipient_selector(update, context)
     
     if data == "save_new_will":
-        async with AsyncSessionLocal() as session:
-            session.add(Will(
+        async with db_session() as session:
+            [wid] = await add_wills(session, [dict(
                 user_id=update.effective_user.id,
                 content=context.user_data['temp_content'],
                 msg_type=context.user_data['temp_type'],
-                recipient_ids=",".join(map(str, context.user_data.get('selected', [])))
-            ))
+                preview=context.user_data.get('temp_preview'),
+            )])
+            await set_will_recipients(session, wid, context.user_data.get('selected', []))
             await session.commit()
-        await query.edit_message_text("✅ 保存成功！", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 返回列表", callback_data="menu_wills")]]))
+        context.user_data.pop(CTX_PICKER_CONTACTS, None)
+        await query.edit_message_text("✅ 保存成功！", reply_markup=BACK_TO_WILLS)
         return ConversationHandler.END
 
 # --- 11. 杂项 ---
 
 async def handle_im_safe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    context.application.create_task(auto_delete_message(context, user.id, update.message.message_id, 0))
+    schedule_delete(user.id, update.message.message_id, 0)
     
-    async with AsyncSessionLocal() as session:
-        u = await get_db_user(session, user.id)
-        if u.is_locked: return
+    # 冻结用户已被拦截器挡住，这里没重置成功只可能是还没绑定守护人
+    if not await record_heartbeat(user.id):
+        msg = await update.message.reply_text("⚠️ 您还没添加守护人，保护机制暂时无法生效。\n请去【守护人管理】添加信任的朋友。", reply_markup=get_main_menu())
+        schedule_delete(user.id, msg.message_id, 5)
+        return
 
-        contacts = await get_contacts(session, user.id)
-        if not contacts:
-            msg = await update.message.reply_text("⚠️ 您还没添加守护人，保护机制暂时无法生效。\n请去【守护人管理】添加信任的朋友。", reply_markup=get_main_menu())
-            context.application.create_task(auto_delete_message(context, user.id, msg.message_id, 5))
-            return
-        
-        u.last_active = datetime.now(timezone.utc)
-        u.status = 'active'
-        await session.commit()
-        
     msg = await update.message.reply_text(f"✅ 已确认平安！\n倒计时已重置，我会继续默默守护您。", reply_markup=get_main_menu())
-    context.application.create_task(auto_delete_message(context, user.id, msg.message_id, 10))
+    schedule_delete(user.id, msg.message_id, 10)
 
 async def confirm_bind_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -699,14 +1170,18 @@ async def confirm_bind_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text("已拒绝")
         return
     rid = int(query.data.split("_")[2])
-    async with AsyncSessionLocal() as session:
+    async with db_session() as session:
         exists = (await session.execute(select(EmergencyContact).where(EmergencyContact.owner_chat_id == rid, EmergencyContact.contact_chat_id == update.effective_user.id))).scalar()
         if not exists:
-            session.add(EmergencyContact(owner_chat_id=rid, contact_chat_id=update.effective_user.id, contact_name=update.effective_user.first_name))
+            await add_contacts(session, [dict(owner_chat_id=rid, contact_chat_id=update.effective_user.id, contact_name=update.effective_user.first_name)])
             await session.commit()
     await query.edit_message_text("✅ 接受成功！您已成为他的守护人。")
     try: await context.bot.send_message(rid, "🎉 好消息！\n对方已接受您的请求，现在他是您的守护人了。")
-    except: pass
+    except TelegramError as e:
+        logger.warning(f"⚠️ 绑定成功通知发送失败 {rid}: {e}")
+
+async def answer_stale_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer("这个按钮已失效，请重新打开菜单")
 
 async def cancel_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query: await update.callback_query.message.edit_text("已取消")
@@ -718,7 +1193,7 @@ async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         link = f"https://t.me/{context.bot.username}?start=connect_{update.effective_user.id}"
         results = [
             InlineQueryResultArticle(
-                id=str(uuid4()),
+                id=secrets.token_urlsafe(8),
                 title="发送邀请函",
                 description="邀请对方成为您的守护人",
                 input_message_content=InputTextMessageContent(
@@ -728,13 +1203,14 @@ async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🤝 接受委托", url=link)]])
             )
         ]
-        await update.inline_query.answer(results, cache_time=0)
+        # 邀请内容只和发起人有关：让 Telegram 按用户缓存结果，重复输入 invite 不必每次都回到机器人
+        await update.inline_query.answer(results, cache_time=300, is_personal=True)
 
 async def handle_security(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 删除用户的触发消息以保持清洁
     try:
         await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
-    except:
+    except TelegramError:
         pass
 
     text = (
@@ -756,39 +1232,240 @@ async def handle_security(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(kb)
     )
 
+# 失联群发的并发上限，守护人之间并发发送，但不超过 Telegram 的全局限速
+SWEEP_SEND_LIMIT = asyncio.Semaphore(20)
+# 多个失联用户可能共用同一位守护人：按守护人加锁，一个用户的预警和信件发完再发下一个
+_guardian_locks = weakref.WeakValueDictionary()
+
+def _guardian_lock(chat_id):
+    lock = _guardian_locks.get(chat_id)
+    if lock is None:
+        lock = _guardian_locks[chat_id] = asyncio.Lock()
+    return lock
+
+async def notify_guardian(bot, chat_id, alert, letters):
+    """给一位守护人发预警和指定给他的信件；同一个人收到的消息保持先后顺序"""
+    async with _guardian_lock(chat_id), SWEEP_SEND_LIMIT:
+        try:
+            await bot.send_message(chat_id, alert, parse_mode=ParseMode.MARKDOWN)
+            for recipients, msg_type, content in letters:
+                if chat_id in recipients:
+                    if msg_type=='text': await bot.send_message(chat_id, f"🔐 预设信件:\n{content}")
+                    else: await bot.send_message(chat_id, "🔐 [收到一份加密文件]")
+        except Forbidden:
+            # 守护人屏蔽了机器人，后续消息也发不出去
+            logger.warning(f"⚠️ 守护人 {chat_id} 已屏蔽机器人，预警未送达")
+        except TelegramError as e:
+            # 429 已由 AIORateLimiter 按 retry_after 重试过，到这里说明确实发不出去
+            logger.warning(f"⚠️ 给守护人 {chat_id} 的预警发送失败: {e}")
+
+SWEEP_BATCH_SIZE = 500
+
+async def alert_guardians(app: Application, user):
+    """给一位失联用户的所有守护人发预警和指定给他们的信件"""
+    # 每封信的接收人只解析一次、正文只解密一次，而不是每个守护人重复一遍
+    wills = [w for w in user.wills if w.recipients]
+    texts = [w for w in wills if w.msg_type == 'text']
+    decrypted = await asyncio.gather(*(run_crypto(decrypt_data, w.content) for w in texts))
+    plaintext = {w.id: p for w, p in zip(texts, decrypted)}
+    letters = [
+        (
+            frozenset(r.contact_chat_id for r in w.recipients),
+            w.msg_type,
+            plaintext.get(w.id),
+        )
+        for w in wills
+    ]
+    alert = f"🚨 紧急预警\n用户 {user.username or user.chat_id} 已失联（长时间未报平安）。"
+    results = await asyncio.gather(
+        *(notify_guardian(app.bot, c.contact_chat_id, alert, letters) for c in user.contacts),
+        return_exceptions=True
+    )
+    for contact, res in zip(user.contacts, results):
+        if isinstance(res, Exception):
+            logger.error(f"❌ 通知守护人 {contact.contact_chat_id} 失败（用户 {user.chat_id}）", exc_info=res)
+
 async def check_dead_mans_switch(app: Application):
+    # 失联判定交给数据库：只取出已超时的用户，守护人和信件一次性预加载
+    overdue = User.last_active + func.make_interval(0, 0, 0, 0, User.check_frequency) < func.now()
+    stmt = (
+        select(User)
+        .options(selectinload(User.contacts), selectinload(User.wills).selectinload(Will.recipients))
+        .where(User.status == 'active', overdue)
+        .execution_options(yield_per=SWEEP_BATCH_SIZE)
+    )
     async with AsyncSessionLocal() as session:
-        users = (await session.execute(select(User).where(User.status == 'active'))).scalars().all()
-        now = datetime.now(timezone.utc)
-        for user in users:
-            last = user.last_active if user.last_active.tzinfo else user.last_active.replace(tzinfo=timezone.utc)
-            delta = (now - last).total_seconds() / 3600
-            if delta > user.check_frequency:
-                contacts = await get_contacts(session, user.chat_id)
-                wills = await get_wills(session, user.chat_id)
-                for c in contacts:
-                    try:
-                        await app.bot.send_message(c.contact_chat_id, f"🚨 紧急预警\n用户 {user.username or user.chat_id} 已失联（长时间未报平安）。", parse_mode=ParseMode.MARKDOWN)
-                        for w in wills:
-                            if w.recipient_ids and str(c.contact_chat_id) in w.recipient_ids.split(","):
-                                content = decrypt_data(w.content)
-                                if w.msg_type=='text': await app.bot.send_message(c.contact_chat_id, f"🔐 预设信件:\n{content}")
-                                else: await app.bot.send_message(c.contact_chat_id, "🔐 [收到一份加密文件]")
-                    except: pass
+        # 流式分批读取，常驻内存的用户数只和批大小有关
+        result = await session.stream_scalars(stmt)
+        async for users in result.partitions():
+            # 同一批用户并发通知，一个慢的守护人不会拖住其他人
+            results = await asyncio.gather(*(alert_guardians(app, u) for u in users), return_exceptions=True)
+            for user, res in zip(users, results):
+                if isinstance(res, Exception):
+                    logger.error(f"❌ 用户 {user.chat_id} 的失联通知失败", exc_info=res)
                 user.status = 'inactive'
-                session.add(user)
         await session.commit()
 
+def _add_missing_columns(sync_conn):
+    # create_all 不会修改已有的表，新加的（可空）列在这里用 ALTER TABLE 补上
+    inspector = sa_inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name): continue
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing: continue
+            col_type = column.type.compile(dialect=sync_conn.dialect)
+            sync_conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}')
+            logger.info(f"🧱 已为 {table.name} 表补充 {column.name} 列")
+
+def _dedupe_contacts(sync_conn):
+    # 加唯一索引前先清掉历史上重复绑定的守护人，每组只保留最早的一条
+    dup = aliased(EmergencyContact)
+    older = select(dup.id).where(
+        dup.owner_chat_id == EmergencyContact.owner_chat_id,
+        dup.contact_chat_id == EmergencyContact.contact_chat_id,
+        dup.id < EmergencyContact.id,
+    ).exists()
+    removed = sync_conn.execute(delete(EmergencyContact).where(older)).rowcount
+    if removed:
+        logger.info(f"🧹 已清理 {removed} 条重复的守护人绑定")
+
+# 已被复合索引覆盖（复合索引的最左列就是它）的旧单列索引，留着只会拖慢写入
+SUPERSEDED_INDEXES = ('ix_wills_user_id', 'ix_contacts_owner_chat_id')
+
+def _create_missing_indexes(sync_conn):
+    # create_all 只在建表时顺带建索引，已有的表需要单独补上新增的索引
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+    for name in SUPERSEDED_INDEXES:
+        sync_conn.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+
+async def _migrate_legacy_recipients():
+    """把旧版逗号分隔的 Will.recipient_ids 搬进 will_recipients 表，可重复执行"""
+    async with AsyncSessionLocal() as session:
+        legacy = (await session.execute(select(Will.id, Will.recipient_ids).where(Will.recipient_ids != ""))).all()
+        for wid, csv in legacy:
+            await set_will_recipients(session, wid, {int(x) for x in csv.split(",") if x.strip()})
+        if legacy:
+            await session.execute(sa_update(Will).where(Will.id.in_([wid for wid, _ in legacy])).values(recipient_ids=""))
+        await session.commit()
+    if legacy:
+        logger.info(f"📦 已迁移 {len(legacy)} 封信件的接收人到 will_recipients 表")
+
+async def _backfill_will_previews():
+    """给还没有预览列的老文字信件补上加密预览，可重复执行"""
+    async with AsyncSessionLocal() as session:
+        stmt = select(Will).where(Will.msg_type == 'text', Will.preview.is_(None), Will.content.is_not(None))
+        wills = (await session.execute(stmt)).scalars().all()
+        for w in wills:
+            try:
+                w.preview = encrypt_data(cipher_suite.decrypt(w.content.encode()).decode()[:WILL_PREVIEW_LEN])
+            except InvalidToken:
+                logger.warning(f"⚠️ 信件 #{w.id} 无法用现有密钥解密，未生成预览")
+        await session.commit()
+    if wills:
+        logger.info(f"📦 已为 {len(wills)} 封老信件生成预览")
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_dedupe_contacts)
+        await conn.run_sync(_create_missing_indexes)
+    await _migrate_legacy_recipients()
+    await _backfill_will_previews()
+    logger.info("✅ 数据库表结构已同步")
+
+async def _warm_connection():
+    async with AsyncSessionLocal() as session:
+        await session.get(User, 0)
+        await get_contacts(session, 0)
+        await get_will_previews(session, 0)
+        await get_will_recipient_ids(session, 0)
+
+async def warm_db_pool():
+    """启动时把连接池建满，并在每条连接上把高频查询各跑一遍：
+    asyncpg 按连接缓存预编译语句，这样第一批用户就不用替新连接付建连和 PREPARE 的开销。
+    效果只维持到连接被回收（DB_POOL_RECYCLE），之后的新连接照常懒加载"""
+    results = await asyncio.gather(*(_warm_connection() for _ in range(DB_POOL_SIZE)), return_exceptions=True)
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        logger.warning(f"⚠️ 连接池预热有 {len(failed)} 条连接失败: {failed[0]!r}")
+
+ROTATE_BATCH_SIZE = 500
+
+async def rotate_wills():
+    """用当前主密钥重新加密所有信件；按主键分批读写，内存占用与信件总数无关"""
+    rotated, last_id = 0, 0
+    while True:
+        async with AsyncSessionLocal() as session:
+            stmt = select(Will).where(Will.id > last_id).order_by(Will.id).limit(ROTATE_BATCH_SIZE)
+            wills = (await session.execute(stmt)).scalars().all()
+            if not wills: break
+            for w in wills:
+                if not w.content: continue
+                try:
+                    w.content = cipher_suite.rotate(w.content.encode()).decode()
+                    if w.preview:
+                        w.preview = cipher_suite.rotate(w.preview.encode()).decode()
+                    rotated += 1
+                except InvalidToken:
+                    logger.warning(f"⚠️ 信件 #{w.id} 无法用现有密钥解密，已跳过")
+            await session.commit()
+            last_id = wills[-1].id
+    logger.info(f"🔑 密钥轮换完成，共重新加密 {rotated} 封信件")
+
+_background_tasks = []
+
+SWEEP_INTERVAL = 30 * 60   # 秒
+SWEEP_JITTER = 120
+
+async def dead_mans_switch_loop(app: Application):
+    # 一轮扫描结束后才开始计时，天然不会叠加；jitter 让多个实例 / 重启后的扫描时间错开
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL + random.uniform(0, SWEEP_JITTER))
+        try:
+            await check_dead_mans_switch(app)
+        except Exception:
+            logger.exception("❌ 失联扫描异常")
+
+async def start_background_tasks(app: Application):
+    # 用普通 task 而不是 app.create_task：后者会在停机时被等待，而这些 worker 永不结束
+    await load_locked_users()
+    await warm_db_pool()
+    _background_tasks.append(asyncio.create_task(delete_worker(app.bot)))
+    _background_tasks.append(asyncio.create_task(heartbeat_worker()))
+    _background_tasks.append(asyncio.create_task(dead_mans_switch_loop(app)))
+
+async def stop_background_tasks(app: Application):
+    while _background_tasks:
+        _background_tasks.pop().cancel()
+
+# 机器人只处理这三类 update，其余类型（编辑消息、频道消息等）让 Telegram 直接不推送
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
 
 def main():
-    persistence = PicklePersistence(filepath='persistence.pickle')
-    app = Application.builder().token(TOKEN).persistence(persistence).build()
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    persistence = SQLPersistence()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        # 发送走 HTTP/2：大量并发请求复用同一条 TLS 连接，不必为每个请求排队等空闲连接
+        .request(HTTPXRequest(connection_pool_size=64, pool_timeout=5.0, http_version="2"))
+        .persistence(persistence)
+        .concurrent_updates(BotUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        # 统一按 Telegram 的全局 / 单聊天频率限制排队发送，触发 429 时按 retry_after 自动重试
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        # 不用 PTB 自带的 JobQueue，定时扫描由 dead_mans_switch_loop 负责
+        .job_queue(None)
+        .post_init(start_background_tasks)
+        .post_stop(stop_background_tasks)
+        .build()
+    )
 
-    app.add_handler(MessageHandler(filters.ALL, global_lock_interceptor), group=-1)
-    app.add_handler(CallbackQueryHandler(global_lock_interceptor), group=-1)
+    app.add_handler(TypeHandler(Update, global_lock_interceptor), group=-1)
 
     # 1. 解锁流程 (放在前面)
     # 修复：给CallbackQueryHandler增加了精确的 pattern，确保能抓住 "select_locked_" 开头的按钮
@@ -805,7 +1482,7 @@ def main():
 
     # 2. 密码验证流程
     auth_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text([BTN_WILLS, BTN_CONTACTS, BTN_SETTINGS]), request_password_entry)],
+        entry_points=[MessageHandler(filters.Text(PROTECTED_BUTTONS), request_password_entry)],
         states={STATE_VERIFY_PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_password_verification)]},
         fallbacks=[CommandHandler("cancel", cancel_action)], name="auth_gw", persistent=True
     )
@@ -829,19 +1506,35 @@ def main():
     app.add_handler(MessageHandler(filters.Text(BTN_SECURITY), handle_security))
     
     # 全局回调
-    app.add_handler(CallbackQueryHandler(handle_global_callbacks, pattern="^(menu_|view_|reveal_|del_|try_|do_|set_freq_|edit_|tgl_|save_|cancel)"))
-    app.add_handler(CallbackQueryHandler(confirm_bind_callback, pattern="^accept_bind_"))
+    app.add_handler(CallbackQueryHandler(handle_global_callbacks, pattern=CALLBACK_PATTERN))
+    app.add_handler(CallbackQueryHandler(confirm_bind_callback, pattern="^(accept_bind_|decline_bind$)"))
     app.add_handler(InlineQueryHandler(inline_query_handler))
+    # 兜底：流程结束后残留的旧按钮（save_new_will、sel_rec_ 等）没有 handler 接，也要应答，否则客户端一直转圈
+    app.add_handler(CallbackQueryHandler(answer_stale_callback))
+
+    # 显式创建唯一的事件循环：建表和 PTB 之后的运行都在这个循环上，连接池不会跨循环
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if AUTO_CREATE_TABLES:
+        loop.run_until_complete(init_db())
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(init_db())
-    
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(check_dead_mans_switch, 'interval', minutes=30, args=[app])
-    scheduler.start()
-    
     print("🚀 死了么LifeSignal Final Stable is running...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES, timeout=30)
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ["migrate"]:
+        asyncio.run(init_db())
+    elif sys.argv[1:] == ["rotate-keys"]:
+        asyncio.run(rotate_wills())
+    else:
+        main()